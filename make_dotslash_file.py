@@ -1,11 +1,18 @@
 import argparse
-from typing import Final
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import sys
+import tempfile
+from typing import Any, Final
+import urllib.error
 import urllib.request
 import json
 from dataclasses import dataclass
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Asset:
     name: str
     browser_download_url: str
@@ -13,7 +20,7 @@ class Asset:
     size: int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Release:
     name: str
     tag_name: str
@@ -22,125 +29,290 @@ class Release:
     assets: list[Asset]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PlatformConfig:
     marker: str
     flavor: str
     path: str
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Platform:
     name: str
     free_threaded: bool = False
 
 
-PLATFORMS: Final[dict[Platform, PlatformConfig]] = {
-    Platform("linux-aarch64"): PlatformConfig(
-        marker="aarch64-unknown-linux-gnu",
-        flavor="install_only_stripped",
-        path="python/bin/python",
+# (platform, flavor) -> (marker, path); free-threaded builds are the ones whose
+# flavor starts with "freethreaded"
+PLATFORM_TABLE: Final[dict[tuple[str, str], tuple[str, str]]] = {
+    ("linux-aarch64", "install_only_stripped"): (
+        "aarch64-unknown-linux-gnu",
+        "python/bin/python",
     ),
-    Platform("linux-aarch64", free_threaded=True): PlatformConfig(
-        marker="aarch64-unknown-linux-gnu",
-        flavor="freethreaded+lto-full",
-        path="python/install/bin/python",
+    ("linux-aarch64", "freethreaded+lto-full"): (
+        "aarch64-unknown-linux-gnu",
+        "python/install/bin/python",
     ),
-    Platform("linux-x86_64"): PlatformConfig(
-        marker="x86_64_v3-unknown-linux-gnu",
-        flavor="install_only_stripped",
-        path="python/bin/python",
+    ("linux-x86_64", "install_only_stripped"): (
+        "x86_64_v3-unknown-linux-gnu",
+        "python/bin/python",
     ),
-    Platform("linux-x86_64", free_threaded=True): PlatformConfig(
-        marker="x86_64_v3-unknown-linux-gnu",
-        flavor="freethreaded+pgo+lto-full",
-        path="python/install/bin/python",
+    ("linux-x86_64", "freethreaded+pgo+lto-full"): (
+        "x86_64_v3-unknown-linux-gnu",
+        "python/install/bin/python",
     ),
-    Platform("macos-aarch64"): PlatformConfig(
-        marker="aarch64-apple-darwin",
-        flavor="install_only_stripped",
-        path="python/bin/python",
+    ("macos-aarch64", "install_only_stripped"): (
+        "aarch64-apple-darwin",
+        "python/bin/python",
     ),
-    Platform("macos-aarch64", free_threaded=True): PlatformConfig(
-        marker="aarch64-apple-darwin",
-        flavor="freethreaded+pgo+lto-full",
-        path="python/install/bin/python",
+    ("macos-aarch64", "freethreaded+pgo+lto-full"): (
+        "aarch64-apple-darwin",
+        "python/install/bin/python",
     ),
-    Platform("macos-x86_64"): PlatformConfig(
-        marker="x86_64-apple-darwin",
-        flavor="install_only_stripped",
-        path="python/bin/python",
+    ("macos-x86_64", "install_only_stripped"): (
+        "x86_64-apple-darwin",
+        "python/bin/python",
     ),
-    Platform("macos-x86_64", free_threaded=True): PlatformConfig(
-        marker="x86_64-apple-darwin",
-        flavor="freethreaded+pgo+lto-full",
-        path="python/install/bin/python",
+    ("macos-x86_64", "freethreaded+pgo+lto-full"): (
+        "x86_64-apple-darwin",
+        "python/install/bin/python",
     ),
-    # "windows-aarch64": PlatformConfig(...),
-    Platform("windows-x86_64"): PlatformConfig(
-        marker="x86_64-pc-windows-msvc-shared",
-        flavor="install_only_stripped",
-        path="python/python.exe",
+    # ("windows-aarch64", ...): (...),
+    ("windows-x86_64", "install_only_stripped"): (
+        "x86_64-pc-windows-msvc-shared",
+        "python/python.exe",
     ),
-    Platform("windows-x86_64", free_threaded=True): PlatformConfig(
-        marker="x86_64-pc-windows-msvc-shared",
-        flavor="freethreaded+pgo-full",
-        path="python/install/python.exe",
+    ("windows-x86_64", "freethreaded+pgo-full"): (
+        "x86_64-pc-windows-msvc-shared",
+        "python/install/python.exe",
     ),
 }
 
+PLATFORMS: Final[dict[Platform, PlatformConfig]] = {
+    Platform(name, free_threaded=flavor.startswith("freethreaded")): PlatformConfig(
+        marker=marker, flavor=flavor, path=path
+    )
+    for (name, flavor), (marker, path) in PLATFORM_TABLE.items()
+}
+
+# Sorted by name once, so descriptors are built in the order they're written out in
+# and the output needs no sorting (see platform_descriptor and main).
+_SORTED_PLATFORMS: Final[tuple[tuple[Platform, PlatformConfig], ...]] = tuple(
+    sorted(PLATFORMS.items(), key=lambda kv: kv[0].name)
+)
+_PLATFORMS_NORMAL: Final[tuple[Platform, ...]] = tuple(
+    p for p, _ in _SORTED_PLATFORMS if not p.free_threaded
+)
+_PLATFORMS_FREETHREADED: Final[tuple[Platform, ...]] = tuple(
+    p for p, _ in _SORTED_PLATFORMS if p.free_threaded
+)
+
+# Several platforms share a marker, so group them to search each asset name for every
+# distinct marker only once.
+PLATFORMS_BY_MARKER: Final[dict[str, list[tuple[str, Platform]]]] = {
+    marker: [(cfg.flavor, p) for p, cfg in PLATFORMS.items() if cfg.marker == marker]
+    for marker in dict.fromkeys(cfg.marker for cfg in PLATFORMS.values())
+}
+
+
+RELEASE_URL: Final = (
+    "https://api.github.com/repos/astral-sh/python-build-standalone/releases/latest"
+)
+MANIFEST_NAME: Final = "SHA256SUMS"
+
+
+def cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "python-dotslash"
+
+
+def write_cache(path: Path, data: bytes) -> None:
+    # the cache is only an optimization, never fail the run because of it
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # cached files are trusted without revalidation, so they must never be seen
+        # half-written by a concurrent run (or worker thread)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
+
 
-def fetch_latest_release() -> Release:
-    with urllib.request.urlopen(
-        "https://api.github.com/repos/astral-sh/python-build-standalone/releases/latest"
-    ) as response:
+def fetch(url: str) -> bytes:
+    with urllib.request.urlopen(url) as response:
         if response.status != 200:
-            raise RuntimeError(f"Failed to fetch release info: {response.status}")
-        release_data = json.loads(response.read())
-        return Release(
-            name=release_data["name"],
-            tag_name=release_data["tag_name"],
-            draft=release_data["draft"],
-            prerelease=release_data["prerelease"],
-            assets=[
-                Asset(
-                    name=asset["name"],
-                    browser_download_url=asset["browser_download_url"],
-                    state=asset["state"],
-                    size=asset["size"],
-                )
+            raise RuntimeError(f"Failed to fetch {url}: {response.status}")
+        data: bytes = response.read()
+        return data
+
+
+ASSET_FIELDS: Final = ("name", "browser_download_url", "state", "size")
+
+
+def parse_release(release_data: dict[str, Any], version: str) -> Release:
+    # only materialize the archives for the requested version (and the digest
+    # manifest), the release carries every other supported version as well as a
+    # .sha256 file next to each archive
+    prefix = f"cpython-{version}."
+    return Release(
+        name=release_data["name"],
+        tag_name=release_data["tag_name"],
+        draft=release_data["draft"],
+        prerelease=release_data["prerelease"],
+        assets=[
+            Asset(
+                name=asset["name"],
+                browser_download_url=asset["browser_download_url"],
+                state=asset["state"],
+                size=asset["size"],
+            )
+            for asset in release_data["assets"]
+            if asset["name"] == MANIFEST_NAME
+            or (
+                asset["name"].startswith(prefix)
+                and not asset["name"].endswith(".sha256")
+            )
+        ],
+    )
+
+
+def fetch_latest_release(version: str) -> Release:
+    # "latest" moves rarely, so revalidate the cached copy with its ETag instead of
+    # downloading the whole payload again (304s also don't count against rate limits)
+    cache_path = cache_dir() / "releases.json"
+    # anything unexpected in the cache file just means there's no usable cache
+    cached: tuple[str, Release] | None = None
+    try:
+        cache_data = json.loads(cache_path.read_bytes())
+        if not isinstance(cache_data["etag"], str):
+            raise TypeError("etag")
+        cached = (cache_data["etag"], parse_release(cache_data["release"], version))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    request = urllib.request.Request(RELEASE_URL)
+    if cached is not None:
+        request.add_header("If-None-Match", cached[0])
+    try:
+        with urllib.request.urlopen(request) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Failed to fetch release info: {response.status}")
+            etag = response.headers.get("ETag")
+            release_data = json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or cached is None:
+            raise
+        # the error wraps the still open response
+        e.close()
+        return cached[1]
+    if etag is not None:
+        # the cache is shared between versions, so it keeps every asset (but only the
+        # fields we read)
+        trimmed = {
+            "name": release_data["name"],
+            "tag_name": release_data["tag_name"],
+            "draft": release_data["draft"],
+            "prerelease": release_data["prerelease"],
+            "assets": [
+                {field: asset[field] for field in ASSET_FIELDS}
                 for asset in release_data["assets"]
             ],
-        )
+        }
+        cache_data = {"etag": etag, "release": trimmed}
+        # compact separators keep the file (and parsing it on the next run) small
+        write_cache(cache_path, json.dumps(cache_data, separators=(",", ":")).encode())
+    return parse_release(release_data, version)
 
 
-def find_asset_for_platform(
-    release: Release, version: str, platform: Platform
-) -> Asset:
-    ret: list[Asset] = []
-    platform_cfg = PLATFORMS[platform]
-    for asset in release.assets:
-        if not asset.name.startswith(f"cpython-{version}."):
-            continue
-        if asset.name.endswith(".sha256"):
+def fetch_immutable(url: str) -> bytes:
+    # published release files never change, so a cached copy never needs revalidating
+    cache_path = cache_dir() / "immutable" / hashlib.sha256(url.encode()).hexdigest()
+    try:
+        return cache_path.read_bytes()
+    except OSError:
+        pass
+    data = fetch(url)
+    write_cache(cache_path, data)
+    return data
+
+
+def fetch_digest(url: str) -> str:
+    return fetch_immutable(url).strip().decode("ascii")
+
+
+def fetch_digests(release: Release, assets: list[Asset]) -> dict[str, str]:
+    # one request for the release-wide manifest instead of one per asset
+    manifest_asset = next((a for a in release.assets if a.name == MANIFEST_NAME), None)
+    if manifest_asset is None:
+        # releases without a manifest only have the per-asset digests, so at least
+        # overlap those requests
+        with ThreadPoolExecutor(max_workers=len(PLATFORMS)) as executor:
+            digests = executor.map(
+                fetch_digest, [f"{a.browser_download_url}.sha256" for a in assets]
+            )
+            return {asset.name: digest for asset, digest in zip(assets, digests)}
+    manifest = fetch_immutable(manifest_asset.browser_download_url)
+    # each line looks like "<hex digest>  <asset name>"
+    all_digests: dict[str, str] = {}
+    for line in manifest.decode("ascii").splitlines():
+        if not line:
             continue
-        if platform_cfg.marker in asset.name and platform_cfg.flavor in asset.name:
-            ret.append(asset)
-    if len(ret) > 1:
-        raise ValueError(
-            f"More than one asset matches {platform_cfg} for {version=}, {platform=}. Candidates: {[a.name for a in ret]}"
-        )
-    if len(ret) == 0:
-        raise ValueError(
-            f"No assets found for {version=}, {platform=} in {release.name=}"
-        )
-    return ret[0]
+        digest, name = line.split()
+        all_digests[name] = digest
+    ret: dict[str, str] = {}
+    for asset in assets:
+        if asset.name not in all_digests:
+            raise ValueError(
+                f"No digest for {asset.name} in {MANIFEST_NAME} of {release.name=}"
+            )
+        ret[asset.name] = all_digests[asset.name]
+    return ret
+
+
+def find_assets_for_platforms(
+    release: Release, version: str, platforms: tuple[Platform, ...]
+) -> dict[Platform, Asset]:
+    # match every platform in a single pass over the assets instead of rescanning
+    # the whole release once per platform
+    candidates: dict[Platform, list[Asset]] = {p: [] for p in platforms}
+    groups: list[tuple[str, list[tuple[str, Platform]]]] = []
+    for marker, flavors in PLATFORMS_BY_MARKER.items():
+        selected = [(flavor, p) for flavor, p in flavors if p in candidates]
+        if selected:
+            groups.append((marker, selected))
+    for asset in release.assets:
+        name = asset.name
+        for marker, flavors in groups:
+            if marker not in name:
+                continue
+            # no early exit, every platform sees every asset so ambiguous matches
+            # are still reported
+            for flavor, platform in flavors:
+                if flavor in name:
+                    candidates[platform].append(asset)
+    ret: dict[Platform, Asset] = {}
+    for platform, assets in candidates.items():
+        if len(assets) > 1:
+            raise ValueError(
+                f"More than one asset matches {PLATFORMS[platform]} for {version=}, {platform=}. Candidates: {[a.name for a in assets]}"
+            )
+        if len(assets) == 0:
+            raise ValueError(
+                f"No assets found for {version=}, {platform=} in {release.name=}"
+            )
+        ret[platform] = assets[0]
+    return ret
 
 
 ALLOWED_EXTENSIONS = ["tar.gz", "tar.zst"]
 
 
-def platform_descriptor(platform: Platform, asset: Asset) -> object:
+def platform_descriptor(platform: Platform, asset: Asset, digest: str) -> object:
     extension = None
     for ext in ALLOWED_EXTENSIONS:
         if asset.browser_download_url.endswith(ext):
@@ -149,22 +321,17 @@ def platform_descriptor(platform: Platform, asset: Asset) -> object:
         raise ValueError(
             f"Asset for {platform=} isn't supported by dotslash: {asset.browser_download_url}"
         )
-    with urllib.request.urlopen(f"{asset.browser_download_url}.sha256") as response:
-        if response.status != 200:
-            raise RuntimeError(
-                f"Failed to fetch digest for {asset.browser_download_url}: {response=}"
-            )
-        digest = bytes(response.read().strip()).decode()
+    # keys are kept in sorted order, the descriptor is written out as is
     return {
-        "size": asset.size,
-        "hash": "sha256",
+        # this is needed on linux/macos so the interpreter can locate the stdlib and
+        # other runtime files; it's ignored on windows
+        "arg0": "underlying-executable",
         "digest": digest,
         "format": extension,
+        "hash": "sha256",
         "path": PLATFORMS[platform].path,
         "providers": [{"url": asset.browser_download_url}],
-        # this is needed on linux/macos so the interpreter can locate the stdlib and
-        # other runtime files; it's ignored on windows
-        "arg0": "underlying-executable",
+        "size": asset.size,
     }
 
 
@@ -177,22 +344,21 @@ def main() -> None:
     args = parser.parse_args()
     version = args.cpython_version
     assert isinstance(version, str)
-    rel = fetch_latest_release()
+    rel = fetch_latest_release(version)
+    selected = _PLATFORMS_FREETHREADED if args.free_threaded else _PLATFORMS_NORMAL
+    assets = find_assets_for_platforms(rel, version, selected)
+    digests = fetch_digests(rel, list(assets.values()))
     platform_descriptors = {
-        platform.name: platform_descriptor(
-            platform, find_asset_for_platform(rel, version, platform)
-        )
-        for platform in PLATFORMS.keys()
-        if platform.free_threaded == args.free_threaded
+        platform.name: platform_descriptor(platform, asset, digests[asset.name])
+        for platform, asset in assets.items()
     }
     version_suffix = "t" if args.free_threaded else ""
     descriptor = {
         "name": f"cpython-{version}{version_suffix}",
         "platforms": platform_descriptors,
     }
-    print("#!/usr/bin/env dotslash")
-    print()
-    print(json.dumps(descriptor, indent=2, sort_keys=True))
+    # every dict above is built in sorted key order already
+    sys.stdout.write(f"#!/usr/bin/env dotslash\n\n{json.dumps(descriptor, indent=2)}\n")
 
 
 if __name__ == "__main__":
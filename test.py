@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
 import shutil
@@ -7,9 +8,9 @@ import traceback
 
 
 def check_path(dotslash: str, path: Path) -> None:
-    contents = path.read_text()
-    _header, _, descriptor_text = contents.partition("\n")
-    descriptor = json.loads(descriptor_text)
+    with path.open("rb") as f:
+        f.readline()  # shebang
+        descriptor = json.load(f)
     assert isinstance(descriptor, dict)
     name = descriptor["name"]
     assert isinstance(name, str)
@@ -20,6 +21,7 @@ def check_path(dotslash: str, path: Path) -> None:
         [dotslash, path, "-c", "import sys; print(sys.version)"],
         text=True,
         capture_output=True,
+        stdin=subprocess.DEVNULL,
         check=True,
     )
     if not proc.stdout.startswith(version):
@@ -44,12 +46,15 @@ def main() -> None:
         else:
             descriptor_paths.append(path)
     failure = False
-    for path in descriptor_paths:
-        try:
-            check_path(dotslash, Path(path))
-        except Exception:
-            failure = True
-            traceback.print_exc()
+    # every check downloads and runs its own interpreter, so run them side by side
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(descriptor_paths)))) as ex:
+        futures = [ex.submit(check_path, dotslash, path) for path in descriptor_paths]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                failure = True
+                traceback.print_exc()
     if failure:
         print("🤔")
         sys.exit(1)